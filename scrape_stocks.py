@@ -1,39 +1,67 @@
 import csv
+import functools
 import io
+import json
 import os
+import re
+import shutil
+import time
 import pandas as pd
 import requests
 import yfinance as yf
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pytz import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from xone import calendar
 
 
 pd.options.mode.chained_assignment = None
 
 REGSHO_FILENAME = 'regsho_data/regsho_data.csv'
+REGSHO_PARQUET_DIR = 'regsho_data/parquet'
+# Parquet parts kept before compacting into one
+REGSHO_PARQUET_MAX_PARTS = 64
 STOCKS_FILENAME = 'stock_data/{}.csv'
+# Seconds before retrying a symbol whose ticker info failed
+TICKER_BACKOFF_TTL = 7 * 24 * 60 * 60
+# Runs of whitespace
+WHITESPACE_RE = re.compile(r'\s+')
 
+UST_CALENDAR = calendar.USTradingCalendar()
+
+@functools.lru_cache(maxsize=256)
 def trading_dates(start_date, end_date):
-	"""Get all trading dates.
+	"""Get all trading dates between two timestamps.
 	"""
-	ust_calendar = calendar.USTradingCalendar()
 	dates = pd.bdate_range(start=start_date, end=end_date)
-	holidays = ust_calendar.holidays(start=start_date, end=end_date)
+	holidays = UST_CALENDAR.holidays(start=start_date, end=end_date)
 	return dates.drop(holidays)
 
+def read_last_line(filename, block_size=256):
+	"""Get last line of a file as bytes.
+	"""
+	with open(filename, 'rb') as f:
+		f.seek(0, 2)
+		fsize = f.tell()
+		size = block_size
+		while True:
+			f.seek(max(fsize - size, 0), 0)
+			buf = f.read().rstrip()
+			# Grow until a full line is buffered
+			if b'\n' in buf or size >= fsize:
+				return buf.rsplit(b'\n', 1)[-1]
+			size *= 2
+
 class REGSHO:
-	def __init__(self, filename, delimiter='|'):
+	def __init__(self, filename, delimiter='|', parquet_dir=None):
 		self.filename = filename
 		self.delimiter = delimiter
+		self.parquet_dir = parquet_dir
 
 		# Create regsho data path
-		path = self.filename.split(os.path.sep)
-		cur_path = ''
-		for p in path[:-1]:
-			cur_path = os.path.join(cur_path, p)
-			if not os.path.exists(cur_path):
-				os.makedirs(cur_path)
+		os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
 
 		self.base_urls = [
 			'http://regsho.finra.org/FNYXshvol{}.txt',
@@ -54,44 +82,118 @@ class REGSHO:
 			'Market': str,
 		}
 
+		# Requests in flight
+		self.max_workers = 16
+
+		# Pooled session shared across dates
+		self.session = requests.Session()
+		adapter = HTTPAdapter(
+			pool_connections=8,
+			pool_maxsize=self.max_workers,
+			max_retries=Retry(total=3, backoff_factor=1))
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
 	def file_exists(self):
-		return os.path.isfile(self.filename)
+		return os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0
 
 	def get_data(self):
 		print('Fetching saved regsho data')
-		return pd.read_csv(self.filename, sep=self.delimiter, dtype=self.dtypes)
+
+		# Read parquet copy if CSV has not changed since
+		if self.parquet_is_current():
+			parquet_files = self.get_parquet_files()
+			data = pd.concat([pd.read_parquet(fn) for fn in parquet_files], ignore_index=True, copy=False)
+			# Compact parts appended by updates
+			if len(parquet_files) > REGSHO_PARQUET_MAX_PARTS:
+				self.rebuild_parquet(data)
+			return data
+
+		# Saved rows are complete, so skip NA detection
+		data = pd.read_csv(
+			self.filename,
+			sep=self.delimiter,
+			dtype=self.dtypes,
+			na_filter=False)
+		data['Date'] = pd.to_datetime(data['Date'], format='%Y%m%d', cache=True)
+
+		# Save parquet copy for next load
+		if self.parquet_dir is not None and len(data) > 0:
+			self.rebuild_parquet(data)
+		return data
+
+	def get_parquet_files(self):
+		"""Get parquet parts in date order.
+		"""
+		if self.parquet_dir is None or not os.path.isdir(self.parquet_dir):
+			return []
+		return sorted(
+			os.path.join(self.parquet_dir, name)
+			for name in os.listdir(self.parquet_dir)
+			if name.endswith('.parquet') and not name.startswith('.'))
+
+	def parquet_is_current(self):
+		"""Check parquet copy is at least as new as CSV.
+		"""
+		parquet_files = self.get_parquet_files()
+		if not parquet_files or not self.file_exists():
+			return False
+		last_mtime = max(os.path.getmtime(fn) for fn in parquet_files)
+		return last_mtime >= os.path.getmtime(self.filename)
+
+	def save_parquet(self, data):
+		"""Write data as a parquet part named by its first date.
+		"""
+		name = '{}.parquet'.format(data['Date'].iloc[0].strftime('%Y%m%d'))
+		tmp_filename = os.path.join(self.parquet_dir, '.' + name)
+		data.to_parquet(tmp_filename, compression='snappy', index=False)
+		os.replace(tmp_filename, os.path.join(self.parquet_dir, name))
+
+	def rebuild_parquet(self, data):
+		"""Replace all parquet parts with a single part.
+		"""
+		shutil.rmtree(self.parquet_dir, ignore_errors=True)
+		os.makedirs(self.parquet_dir)
+		self.save_parquet(data)
 
 	def get_last_date(self):
 		"""Get latest time from CSV.
 		"""
-		last_line = ''
-		with open(self.filename, 'r') as f:
-			f.seek(0, 2)
-			fsize = f.tell()
-			f.seek(max (fsize-4096, 0), 0)
-			lines = f.read().splitlines()
-			last_line = lines[-1]
-		last_date = last_line.split(self.delimiter)[0]
+		last_line = read_last_line(self.filename)
+		last_date = last_line.split(self.delimiter.encode(), 1)[0].decode()
 		last_date = datetime.strptime(last_date, '%Y%m%d')
 		return last_date
 
-	def save_data(self, data, write_header=False):
+	def save_data(self, writer, data, write_header=False):
 		"""Append data to csv.
 		"""
-		with open(self.filename, 'a') as f:
-			data.to_csv(f, header=write_header, index=False, float_format='%.0f', sep=self.delimiter)
+		if write_header:
+			writer.writerow(self.fieldnames)
+		writer.writerows(data.itertuples(index=False))
 
-	def download_data(self, date):
-		# Request
+	def fetch(self, url):
+		"""Request a single REGSHO file.
+		"""
+		return self.session.get(url, timeout=30)
+
+	def download_data(self, date, executor):
+		"""Request all markets of a date on a shared executor.
+		"""
+		return [executor.submit(self.fetch, base_url.format(date)) for base_url in self.base_urls]
+
+	def parse_data(self, results):
 		data = []
-		for base_url in self.base_urls:
-			url = base_url.format(date)
-			result = requests.get(url)
-			content = result.content.decode('utf-8')
-			datum = pd.read_csv(io.StringIO(content), sep='|')
-			datum = datum.dropna()
+		for result in results:
+			datum = pd.read_csv(
+				io.BytesIO(result.content),
+				sep='|',
+				encoding='utf-8',
+				dtype=self.dtypes,
+				usecols=lambda col: col in self.fieldnames,
+				keep_default_na=False,
+				na_values=[''])
 			data.append(datum)
-		data = pd.concat(data)
+		data = pd.concat(data, ignore_index=True, copy=False)
 
 		# Check stock market is closed
 		for col in self.fieldnames:
@@ -100,60 +202,95 @@ class REGSHO:
 
 		data = data[self.fieldnames]
 
-		# Append data to csv
-		self.save_data(data, write_header=(date == '20110301'))
+		# Drop incomplete rows such as the record count footer
+		volumes = ['ShortVolume', 'ShortExemptVolume', 'TotalVolume']
+		data = data.dropna(subset=['Date', 'Symbol'] + volumes)
+		data['Market'] = data['Market'].fillna('')
+
+		# Volumes are whole numbers
+		data[volumes] = data[volumes].round().astype('int64')
 
 		return data
 
 	def update(self):
 		# Earliest data
-		start_date = '3/1/2011'
+		start_date = pd.Timestamp(2011, 3, 1)
 		# Start date from last row in CSV
-		start_date = datetime.strptime(start_date, '%m/%d/%Y')
 		if self.file_exists():
-			start_date = self.get_last_date() + timedelta(days=1)
-		start_date = start_date.strftime('%m/%d/%Y')
+			start_date = pd.Timestamp(self.get_last_date()) + timedelta(days=1)
 
 		# End date from EST date
 		end_date = datetime.now(timezone('US/Eastern'))
 		# Published after 8PM
 		if end_date.hour < 20:
 			end_date = end_date - timedelta(days=1)
-		end_date = end_date.strftime('%m/%d/%Y')
+		end_date = pd.Timestamp(end_date.date())
 
 		# Get all trading dates
-		dates = trading_dates(start_date, end_date).strftime('%Y%m%d')
-
-		for date in dates:
-			# Get data
-			data = self.download_data(date)
-
-			if data is None:
-				print('Closed {}'.format(date))
-			else:
-				print('Fetched {}'.format(date))
+		dates = trading_dates(start_date, end_date).strftime('%Y%m%d').values
+
+		# Rows appended to keep a current parquet copy in sync
+		sync_parquet = self.parquet_is_current()
+		appended = []
+
+		write_header = not self.file_exists()
+		with open(self.filename, 'a', newline='') as f:
+			writer = csv.writer(f, delimiter=self.delimiter, lineterminator='\n')
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				# Dates per chunk so every request is in flight at once
+				chunk_size = max(1, self.max_workers // len(self.base_urls))
+				failed = False
+				for i in range(0, len(dates), chunk_size):
+					# Get data, in date order
+					chunk = dates[i:i + chunk_size]
+					futures = [self.download_data(date, executor) for date in chunk]
+					for date, results in zip(chunk, futures):
+						try:
+							data = self.parse_data([r.result() for r in results])
+						except requests.RequestException:
+							# Stop at first failed date so the next run resumes from it
+							print('Failed {}'.format(date))
+							failed = True
+							break
+
+						if data is None:
+							print('Closed {}'.format(date))
+						else:
+							# Append data to csv
+							self.save_data(writer, data, write_header=write_header)
+							write_header = False
+							if sync_parquet:
+								appended.append(data)
+							print('Fetched {}'.format(date))
+					if failed:
+						break
+
+		# Append new rows to parquet copy as a new part
+		if appended:
+			data = pd.concat(appended, ignore_index=True, copy=False)
+			data['Date'] = pd.to_datetime(data['Date'], format='%Y%m%d', cache=True)
+			self.save_parquet(data)
 		print('REGSHO up-to-date')
 
 class STOCKS:
 	def __init__(self, filename, regsho, delimiter='|'):
 		self.filename = filename
 		self.regsho = regsho
+		# Short volume summed per symbol and date
+		self.short_data = self.regsho.groupby(['Symbol', 'Date'])[['ShortVolume', 'ShortExemptVolume', 'TotalVolume']].sum()
 		self.delimiter = delimiter
 
 		# Create stock data path
-		path = self.filename.split(os.path.sep)
-		cur_path = ''
-		for p in path[:-1]:
-			cur_path = os.path.join(cur_path, p)
-			if not os.path.exists(cur_path):
-				os.makedirs(cur_path)
+		os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+		self.last_dates_filename = os.path.join(os.path.dirname(self.filename), '.last_dates.json')
 
 		# Create symbol data path
 		self.symbol_data_dir = 'symbol_data'
-		if not os.path.exists(self.symbol_data_dir):
-			os.makedirs(self.symbol_data_dir)
+		os.makedirs(self.symbol_data_dir, exist_ok=True)
 		self.symbol_list_filename = os.path.join(self.symbol_data_dir, 'symbol_list.txt')
 		self.symbol_filename = os.path.join(self.symbol_data_dir, 'symbol_data.csv')
+		self.symbol_backoff_dir = os.path.join(self.symbol_data_dir, '.backoff')
+		os.makedirs(self.symbol_backoff_dir, exist_ok=True)
 
 		self.history_options = {
 			# Valid periods: 1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max
@@ -166,9 +303,21 @@ class STOCKS:
 			'prepost': False,
 			# Download stock dividends and stock splits events
 			'actions': True,
-			'threads': False,
+			'threads': True,
 			'progress': False,
 		}
+		# Symbols per batched download
+		self.batch_size = 100
+		# Columns of a single-ticker download
+		self.history_fieldnames = [
+			'Open',
+			'High',
+			'Low',
+			'Close',
+			'Volume',
+			'Dividends',
+			'Stock Splits',
+		]
 		self.ticker_fieldnames = [
 			'symbol',
 			'longName',
@@ -198,25 +347,50 @@ class STOCKS:
 	def sanitize(self, s):
 		"""Sanitize whitespace and delimiter.
 		"""
-		res = s
-		res = res.replace(self.delimiter, ',')
-		res = ' '.join(res.split())
-		return res
+		return WHITESPACE_RE.sub(' ', s.replace(self.delimiter, ',')).strip()
 
 	def get_last_date(self, symbol):
 		"""Get latest time from stock data.
 		"""
-		last_line = ''
-		with open(self.filename.format(symbol), 'r') as f:
-			f.seek(0, 2)
-			fsize = f.tell()
-			f.seek(max (fsize-4096, 0), 0)
-			lines = f.read().splitlines()
-			last_line = lines[-1]
-		last_date = last_line.split(self.delimiter)[0]
+		last_line = read_last_line(self.filename.format(symbol))
+		last_date = last_line.split(self.delimiter.encode(), 1)[0].decode()
 		last_date = datetime.strptime(last_date, '%Y-%m-%d')
 		return last_date
 
+	def get_last_dates(self):
+		"""Get latest saved date of each symbol from index.
+		"""
+		if not os.path.isfile(self.last_dates_filename):
+			return {}
+		with open(self.last_dates_filename, 'r') as f:
+			return json.load(f)
+
+	def save_last_dates(self, last_dates):
+		"""Save latest saved date of each symbol to index.
+		"""
+		tmp_filename = self.last_dates_filename + '.tmp'
+		with open(tmp_filename, 'w') as f:
+			json.dump(last_dates, f)
+		os.replace(tmp_filename, self.last_dates_filename)
+
+	def backoff_filename(self, symbol):
+		return os.path.join(self.symbol_backoff_dir, symbol)
+
+	def is_backed_off(self, symbol):
+		"""Check symbol failed within the backoff period.
+		"""
+		filename = self.backoff_filename(symbol)
+		if not os.path.isfile(filename):
+			return False
+		return time.time() - os.path.getmtime(filename) < TICKER_BACKOFF_TTL
+
+	def back_off(self, symbol):
+		"""Mark symbol as failed so it is not requested again until
+		the backoff period ends.
+		"""
+		with open(self.backoff_filename(symbol), 'w'):
+			pass
+
 	def get_symbols(self):
 		"""Get all symbols.
 		"""
@@ -227,7 +401,7 @@ class STOCKS:
 		return symbols
 
 	def download_symbols(self):
-		symbols = self.get_symbols()
+		symbols = set(self.get_symbols())
 
 		# Check if file exists
 		file_exists = False
@@ -237,11 +411,15 @@ class STOCKS:
 		# Identify missing symbols
 		if file_exists:
 			with open(self.symbol_filename, 'r', encoding='utf-8') as f:
-				dw = csv.DictReader(f, delimiter=self.delimiter)
-				for row in dw:
-					symbol = row['symbol'].strip()
-					if symbol in symbols:
-						symbols.remove(symbol)
+				reader = csv.reader(f, delimiter=self.delimiter)
+				header = next(reader, None)
+				if header is not None:
+					idx = header.index('symbol')
+					for row in reader:
+						# Skip blank rows
+						if len(row) <= idx:
+							continue
+						symbols.discard(row[idx].strip())
 
 		# Update missing symbols
 		with open(self.symbol_filename, 'a', encoding='utf-8') as f:
@@ -249,79 +427,121 @@ class STOCKS:
 			if not file_exists:
 				dw.writeheader()
 
-			for symbol in symbols:
+			for symbol in sorted(symbols):
+				# Skip symbols that failed recently
+				if self.is_backed_off(symbol):
+					print('Skipped {}'.format(symbol))
+					continue
+
 				# Get ticker info
-				ticker = yf.Ticker(symbol)
 				try:
-					info = ticker.info
+					info = yf.Ticker(symbol).info
 					info['longBusinessSummary'] = self.sanitize(info['longBusinessSummary'])
 					dw.writerow(info)
 					print('Fetched {}'.format(symbol))
 				except:
+					self.back_off(symbol)
 					print('Skipped {}'.format(symbol))
 
+	def save_data(self, symbol, data, file_exists):
+		"""Concatenate stock data with short data and append to csv.
+		"""
+		# Concatenate with short data
+		short_data = self.short_data.loc[symbol]
+		short_data = short_data.loc[data.index[0]:data.index[-1]]
+		data = pd.concat([data, short_data], axis=1, copy=False)
+
+		# Remove duplicate indices
+		if data.index.has_duplicates:
+			data = data[~data.index.duplicated(keep='first')]
+
+		# Append to csv
+		with open(self.filename.format(symbol), 'a') as f:
+			data.to_csv(f, header=(not file_exists), index=True, sep=self.delimiter)
+
+		return data.index[-1]
+
 	def update(self):
 		symbols = self.get_symbols()
+		last_dates = self.get_last_dates()
+		last_short_date = self.short_data.index.get_level_values('Date').max()
 
+		# Group symbols sharing the same download range
+		buckets = {}
 		for symbol in symbols:
 			# Check if file exists
 			file_exists = False
 			if os.path.isfile(self.filename.format(symbol)):
 				file_exists = True
 
+			# Skip symbols saved up to latest short data
+			if file_exists and symbol in last_dates:
+				if pd.Timestamp(last_dates[symbol]) >= last_short_date:
+					print('Up-to-date {}'.format(symbol))
+					continue
+
 			# Find greatest common date
-			short_data = self.regsho[self.regsho['Symbol'] == symbol]
-			start = datetime.strptime(short_data['Date'].iloc[0], '%Y%m%d')
-			end = datetime.strptime(short_data['Date'].iloc[-1], '%Y%m%d') + timedelta(days=1)
+			short_dates = self.short_data.loc[symbol].index
+			start = short_dates[0]
+			end = short_dates[-1] + pd.Timedelta('1D')
 
-			try:
-				if file_exists:
+			if file_exists:
+				try:
 					last_date = self.get_last_date(symbol) + timedelta(days=1)
-					last_date = last_date.strftime('%m/%d/%Y')
-
-					# Get all trading dates
-					dates = trading_dates(last_date, end.strftime('%m/%d/%Y')).strftime('%Y-%m-%d')
-
-					if len(dates) == 0:
-						print('Up-to-date {}'.format(symbol))
-						continue
+				except:
+					print('Skipped {}'.format(symbol))
+					continue
+				# Get all trading dates
+				dates = trading_dates(last_date, end).strftime('%Y-%m-%d')
 
-					# Download
-					data = yf.download(
-						tickers=symbol,
-						start=dates[0],
-						**self.history_options)
-				else:
-					# Download
-					data = yf.download(
-						tickers=symbol,
-						start=start.strftime('%Y-%m-%d'),
-						end=end.strftime('%Y-%m-%d'),
-						**self.history_options)
+				if len(dates) == 0:
+					print('Up-to-date {}'.format(symbol))
+					continue
 
-				print('Fetched {} {} - {}'.format(symbol, data.index[0], data.index[-1]))
-			except:
-				print('Skipped {}'.format(symbol))
-				continue
+				key = (dates[0], None, file_exists)
+			else:
+				key = (start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), file_exists)
+			buckets.setdefault(key, []).append(symbol)
 
-			# Concatenate with short data
-			data.index = pd.to_datetime(data.index, format='%Y-%m-%d')
-			short_data['Date'] = pd.to_datetime(short_data['Date'], format='%Y%m%d')
-			short_data = short_data.groupby('Date')[['ShortVolume', 'ShortExemptVolume', 'TotalVolume']].sum()
-			short_data = short_data[short_data.index >= data.index[0]]
-			short_data = short_data[short_data.index <= data.index[-1]]
-			data = pd.concat([data, short_data], axis=1)
+		for (start, end, file_exists), bucket in buckets.items():
+			for i in range(0, len(bucket), self.batch_size):
+				batch = bucket[i:i + self.batch_size]
 
-			# Remove duplicate indices
-			data = data[~data.index.duplicated(keep='first')]
+				# Download
+				try:
+					batch_data = yf.download(
+						tickers=' '.join(batch),
+						start=start,
+						end=end,
+						group_by='ticker',
+						**self.history_options)
+				except:
+					for symbol in batch:
+						print('Skipped {}'.format(symbol))
+					continue
+
+				for symbol in batch:
+					try:
+						# Split per-symbol frame from batch
+						if isinstance(batch_data.columns, pd.MultiIndex):
+							data = batch_data[symbol]
+						else:
+							data = batch_data
+						# Drop dates aligned from other tickers in batch
+						data = data.dropna(how='all')
+						data = data[self.history_fieldnames].astype({'Volume': 'int64'})
+						print('Fetched {} {} - {}'.format(symbol, data.index[0], data.index[-1]))
+					except:
+						print('Skipped {}'.format(symbol))
+						continue
 
-			# Append to csv
-			with open(self.filename.format(symbol), 'a') as f:
-				data.to_csv(f, header=(not file_exists), index=True, sep=self.delimiter)
+					last_date = self.save_data(symbol, data, file_exists)
+					last_dates[symbol] = last_date.strftime('%Y-%m-%d')
+			self.save_last_dates(last_dates)
 		print('STOCKS up-to-date')
 
 if __name__ == '__main__':
-	regsho = REGSHO(filename=REGSHO_FILENAME)
+	regsho = REGSHO(filename=REGSHO_FILENAME, parquet_dir=REGSHO_PARQUET_DIR)
 	regsho.update()
 
 	stocks = STOCKS(filename=STOCKS_FILENAME, regsho=regsho.get_data())